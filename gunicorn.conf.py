@@ -0,0 +1,13 @@
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+worker_class = "uvicorn_worker.UvicornWorker"
+
+# Positions, the flip cooldown and the order queue live in process memory,
+# so a second worker would trade on its own copy of that state. One async
+# worker already handles concurrent alerts on its event loop.
+workers = 1
+
+# Order retries can take a few seconds; don't let gunicorn kill the worker.
+timeout = 60
+graceful_timeout = 30
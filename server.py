@@ -1,20 +1,41 @@
 import sys, io
 sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', errors='replace')
 sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8', errors='replace')
-from flask import Flask, request, jsonify 
-from kiteconnect import KiteConnect
+from quart import Quart, Response, request
+import httpx
+import orjson
+import asyncio
 import os
-from datetime import datetime, time, timedelta
+from datetime import date, timedelta
 import calendar
+import functools
+import hashlib
 import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import atexit
+import random
+import secrets
 import time as time_module
 
 # ---------- LOGGING ----------
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s [%(levelname)s] %(message)s",
+# Request handlers only enqueue records (the message itself is rendered in
+# the calling thread); a background thread adds the timestamp/level prefix
+# and writes them to stdout so log I/O stays off the webhook path.
+_log_queue = queue.SimpleQueue()
+_log_handler = logging.StreamHandler(sys.stdout)
+_log_handler.setFormatter(logging.Formatter(
+    "%(asctime)s [%(levelname)s] %(message)s",
     datefmt="%Y-%m-%d %H:%M:%S"
-)
+))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+_queue_handler = QueueHandler(_log_queue)
+_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=logging.INFO, handlers=[_queue_handler])
+# httpx logs every request at INFO; keep that off the order path.
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ---------- ENV VARS ----------
 DEFAULT_QTY = int(os.environ.get("DEFAULT_QTY", "35"))
@@ -22,212 +43,630 @@ ZERODHA_API_KEY = os.environ.get("ZERODHA_API_KEY")
 ZERODHA_ACCESS_TOKEN = os.environ.get("ZERODHA_ACCESS_TOKEN")
 TEST_MODE = os.environ.get("TEST_MODE", "True") == "True"
 
-app = Flask(__name__)
+# ---------- MARKET HOURS (IST) ----------
+# Bounds are seconds since IST midnight, so the check is plain int math.
+MARKET_OPEN = 9 * 3600 + 15 * 60
+MARKET_CLOSE = 15 * 3600 + 30 * 60
+_IST_OFFSET = 5 * 3600 + 30 * 60
+
+app = Quart(__name__)
+
+def _json(obj, status=200):
+    """Serializes a response body with orjson."""
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+# ---------- KITE REST CLIENT ----------
+# One pooled HTTP/2 client for every Kite call, so LTP, orders and positions
+# reuse the same TLS session instead of handshaking per request.
+CLIENT = httpx.AsyncClient(
+    base_url="https://api.kite.trade",
+    http2=True,
+    # httpx drops idle connections after 5s by default; alerts are usually
+    # further apart than that, so keep them around longer.
+    limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+    headers={
+        "X-Kite-Version": "3",
+        "Authorization": f"token {ZERODHA_API_KEY}:{ZERODHA_ACCESS_TOKEN}",
+    },
+)
+
+@app.before_serving
+async def warm_client():
+    """Opens the TLS session up front so the first alert doesn't pay for it."""
+    if TEST_MODE:
+        return
+    try:
+        await CLIENT.get("/")
+    except httpx.HTTPError as e:
+        logging.warning("⚠️ Could not pre-connect to Kite: %s", e)
+
+@app.after_serving
+async def close_client():
+    await CLIENT.aclose()
+
+class KiteError(Exception):
+    """Kite rejected the request; resending the same payload won't help."""
+
+class TransientKiteError(KiteError):
+    """Network failure, rate limit or 5xx from Kite; safe to retry idempotent calls.
+
+    The request may still have been processed, so orders must be looked up
+    before being sent again.
+    """
 
-kite = KiteConnect(api_key=ZERODHA_API_KEY)
-kite.set_access_token(ZERODHA_ACCESS_TOKEN)
+class UnsentKiteError(TransientKiteError):
+    """The request never reached Kite or was refused by its rate limiter."""
+
+async def kite_request(method, path, **kwargs):
+    """Calls a Kite REST endpoint and returns its `data` payload."""
+    try:
+        resp = await CLIENT.request(method, path, **kwargs)
+    except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+        raise UnsentKiteError(f"Kite unreachable: {e}") from e
+    except httpx.TransportError as e:
+        raise TransientKiteError(f"Kite request failed: {e}") from e
+    try:
+        body = orjson.loads(resp.content)
+    except orjson.JSONDecodeError:
+        body = {}
+    if resp.is_error or body.get("status") != "success":
+        if resp.status_code == 429:
+            error = UnsentKiteError
+        elif resp.status_code >= 500:
+            error = TransientKiteError
+        else:
+            error = KiteError
+        raise error(f"Kite {resp.status_code}: {body.get('message', resp.text)}")
+    return body["data"]
+
+# Fields shared by every leg; only symbol, side and quantity vary per order.
+BASE_ORDER = {"exchange": "NFO", "product": "NRML", "order_type": "MARKET"}
+
+async def place_order_async(**kw):
+    """Places a regular order and returns its order id."""
+    data = await kite_request("POST", "/orders/regular", data=kw)
+    return data["order_id"]
 
 # ---------- FAKE POSITIONS (TEST MODE) ----------
 fake_positions = {}  # store {symbol: qty} in TEST_MODE
 
 def log_positions(final=False):
     """Logs current positions (both test/live)."""
+    if not logging.getLogger().isEnabledFor(logging.INFO):
+        return
     positions = get_current_positions()
+    label = "✅ Final positions" if final else "📌 Current positions"
     if not positions:
-        msg = "✅ Final positions: None" if final else "📌 Current positions: None"
-        logging.info(msg)
+        logging.info("%s: None", label)
     else:
         pretty = [f"{p['tradingsymbol']} x {p['quantity']}" for p in positions]
-        msg = f"✅ Final positions: {', '.join(pretty)}" if final else f"📌 Current positions: {', '.join(pretty)}"
-        logging.info(msg)
+        logging.info("%s: %s", label, ", ".join(pretty))
 
 # ---------- SAFE FUNCTIONS ----------
-def safe_ltp(symbol):
-    for attempt in range(5):
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.05  # seconds; doubles on every attempt
+RETRY_MAX_DELAY = 0.8
+RETRY_DEADLINE = 2.0  # seconds of retrying allowed per call
+
+async def _backoff(attempt, deadline):
+    """Sleeps with capped exponential backoff plus jitter before the next attempt.
+
+    Returns False, without sleeping, when no attempts are left or the next
+    one would start past the deadline.
+    """
+    if attempt + 1 >= RETRY_ATTEMPTS:
+        return False
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt) * (0.5 + random.random())
+    if time_module.monotonic() + delay >= deadline:
+        return False
+    await asyncio.sleep(delay)
+    return True
+
+# Bursty alerts only need the spot to within a second, so recent quotes
+# are reused instead of hitting Kite again.
+LTP_CACHE_TTL = 1.0  # seconds
+_ltp_cache = {}  # {symbol: (monotonic ts, last_price)}
+
+async def safe_ltp(symbol):
+    cached = _ltp_cache.get(symbol)
+    if cached and time_module.monotonic() - cached[0] < LTP_CACHE_TTL:
+        return cached[1]
+    deadline = time_module.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRY_ATTEMPTS):
         try:
-            return kite.ltp([symbol])[symbol]["last_price"]
-        except Exception as e:
-            logging.warning(f"⚠️ LTP retry {attempt+1} failed: {e}")
-            time_module.sleep(1)
-    raise Exception("❌ LTP fetch failed after 2 attempts")
+            quote = await kite_request("GET", "/quote/ltp", params={"i": symbol})
+            price = quote[symbol]["last_price"]
+            _ltp_cache[symbol] = (time_module.monotonic(), price)
+            return price
+        except TransientKiteError as e:
+            logging.warning("⚠️ LTP retry %d failed: %s", attempt + 1, e)
+            if not await _backoff(attempt, deadline):
+                break
+    raise Exception(f"❌ LTP fetch failed after {attempt + 1} attempts")
 
-def place_order(symbol, qty=DEFAULT_QTY, transaction_type="BUY"):
-    """Unified order placing with retries"""
-    for attempt in range(5):
+def order_payload(symbol, transaction_type, qty=DEFAULT_QTY):
+    """Builds and validates the Kite order payload for one leg."""
+    if not symbol:
+        raise ValueError(f"❌ No symbol for {transaction_type} leg")
+    if qty <= 0:
+        raise ValueError(f"❌ Invalid quantity {qty} for {symbol}")
+    return dict(BASE_ORDER, tradingsymbol=symbol, transaction_type=transaction_type, quantity=qty)
+
+ORDER_FILL_TIMEOUT = 3.0  # seconds to wait for a market order to fill
+
+ORDER_LOOKUP_TIMEOUT = 3.0  # seconds to look for an order whose POST failed mid-flight
+
+async def find_order_by_tag(tag, timeout=ORDER_LOOKUP_TIMEOUT, interval=0.25):
+    """Polls the order book for the order carrying `tag`; returns its id or None."""
+    deadline = time_module.monotonic() + timeout
+    while True:
         try:
-            kite.place_order(
-                variety="regular",
-                exchange="NFO",
-                tradingsymbol=symbol,
-                transaction_type=transaction_type,
-                quantity=qty,
-                order_type="MARKET",
-                product="NRML"
-            )
-            logging.info(f"✅ Order success: {transaction_type} {symbol} x {qty}")
-            return True
-        except Exception as e:
-            logging.warning(f"⚠️ Order retry {attempt+1} failed: {e}")
-            time_module.sleep(1)
-    raise Exception("❌ Order failed after 2 attempts")
+            for o in reversed(await kite_request("GET", "/orders")):
+                if o.get("tag") == tag:
+                    return o["order_id"]
+        except TransientKiteError as e:
+            logging.warning("⚠️ Order book lookup failed: %s", e)
+        if time_module.monotonic() >= deadline:
+            return None
+        await asyncio.sleep(interval)
+
+async def _place_with_retries(order):
+    """Places a tagged order, resending only requests that never reached Kite.
+
+    Connection failures and 429s are retried with backoff. After any other
+    transient failure (timeout mid-response, 5xx) Kite may already have
+    taken the order, and its tag is no idempotency key, so the order is
+    never resent: the order book is polled for the tag instead, and if it
+    doesn't show up the order is left unresolved and we raise.
+    """
+    deadline = time_module.monotonic() + RETRY_DEADLINE
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return await place_order_async(**order)
+        except UnsentKiteError as e:
+            logging.warning("⚠️ Order retry %d failed: %s", attempt + 1, e)
+            if not await _backoff(attempt, deadline):
+                break
+        except TransientKiteError as e:
+            logging.warning("⚠️ Order outcome unknown, checking order book: %s", e)
+            order_id = await find_order_by_tag(order["tag"])
+            if order_id:
+                return order_id
+            _unresolved_tags.add(order["tag"])
+            logging.error("❌ Order %s not found after failed send → halting trading until reconciled", order["tag"])
+            raise
+    raise Exception(f"❌ Order failed after {attempt + 1} attempts")
+
+ORDER_CANCEL_TIMEOUT = 2.0  # seconds to wait for a cancel to settle
+
+async def cancel_order(order_id):
+    """Cancels an open order and returns its latest state."""
+    try:
+        await kite_request("DELETE", f"/orders/regular/{order_id}")
+    except KiteError as e:
+        # Kite refuses to cancel orders that already completed; the poll
+        # below tells us what actually happened.
+        logging.warning("⚠️ Cancel of order %s failed: %s", order_id, e)
+    return await poll_order(order_id, timeout=ORDER_CANCEL_TIMEOUT)
+
+async def submit_order(order):
+    """Places a prepared order payload and waits for it to fill.
+
+    An order id only means Kite accepted the order; margin/RMS rejections
+    show up later as REJECTED. Positions are only updated from the filled
+    quantity, and anything short of COMPLETE raises. An order that hasn't
+    settled in time is cancelled; if even that can't be confirmed, its tag
+    is left in _unresolved_tags so no further alerts trade until a
+    reconcile has seen how it ended.
+    """
+    global _orders_in_flight, _last_order_at
+    order = dict(order, tag=secrets.token_hex(8))
+    _orders_in_flight += 1
+    try:
+        order_id = await _place_with_retries(order)
+        state = await poll_order(order_id, timeout=ORDER_FILL_TIMEOUT)
+        if state.get("status") not in ORDER_FINAL_STATUSES:
+            logging.warning("⚠️ Order %s not filled within %ss (status: %s) → cancelling",
+                            order_id, ORDER_FILL_TIMEOUT, state.get("status"))
+            state = await cancel_order(order_id)
+        status = state.get("status")
+        filled = state.get("filled_quantity") or 0
+        if status == "COMPLETE":
+            record_order(order, filled or order["quantity"])
+            logging.info("✅ Order filled: %s %s x %s (id: %s)",
+                         order["transaction_type"], order["tradingsymbol"], filled or order["quantity"], order_id)
+            return order_id
+        if filled:
+            record_order(order, filled)
+        if status in ("REJECTED", "CANCELLED"):
+            raise KiteError(f"❌ Order {order_id} {status}: {state.get('status_message')}")
+        _unresolved_tags.add(order["tag"])
+        logging.error("❌ Order %s unresolved (status: %s) → halting trading until reconciled", order_id, status)
+        raise Exception(f"❌ Order {order_id} not filled or cancelled (status: {status})")
+    finally:
+        _orders_in_flight -= 1
+        _last_order_at = time_module.monotonic()
+
+async def place_order(symbol, qty=DEFAULT_QTY, transaction_type="BUY"):
+    """Unified order placing with retries"""
+    return await submit_order(order_payload(symbol, transaction_type, qty))
+
+ORDER_FINAL_STATUSES = ("COMPLETE", "REJECTED", "CANCELLED")
+
+async def poll_order(order_id, timeout=1.0, interval=0.1):
+    """Polls an order until it reaches a terminal status or times out.
 
-def exit_position(symbol, qty=DEFAULT_QTY):
+    Returns the latest entry of the order's history ({} if none was seen).
+    """
+    deadline = asyncio.get_running_loop().time() + timeout
+    state = {}
+    while True:
+        try:
+            history = await kite_request("GET", f"/orders/{order_id}")
+            state = history[-1] if history else state
+        except TransientKiteError as e:
+            logging.warning("⚠️ Order %s status check failed: %s", order_id, e)
+        if state.get("status") in ORDER_FINAL_STATUSES:
+            return state
+        if asyncio.get_running_loop().time() >= deadline:
+            return state
+        await asyncio.sleep(interval)
+
+async def exit_position(symbol, qty=DEFAULT_QTY):
     """Exit a position safely (opposite side order)."""
-    return place_order(symbol, qty, transaction_type="SELL")
+    return await place_order(symbol, qty, transaction_type="SELL")
 
 # ---------- HELPER FUNCTIONS ----------
 def is_market_open():
-    now = datetime.utcnow() + timedelta(hours=5, minutes=30)
-    current_time = now.time()
-    return time(9, 15) <= current_time <= time(15, 30)
+    seconds = (int(time_module.time()) + _IST_OFFSET) % 86400
+    return MARKET_OPEN <= seconds <= MARKET_CLOSE
 
 def get_monthly_expiry():
-    today = datetime.today()
-    year, month = today.year, today.month
+    return _expiry_for(date.today().toordinal())
 
-    def last_tuesday(y, m):
-        last_day = calendar.monthrange(y, m)[1]
-        d = datetime(y, m, last_day)
-        while d.weekday() != 1:
-            d -= timedelta(days=1)
-        return d
+def _last_tuesday(y, m):
+    last_day = date(y, m, calendar.monthrange(y, m)[1])
+    return last_day - timedelta(days=(last_day.weekday() - 1) % 7)
+
+@functools.lru_cache(maxsize=2)
+def _expiry_for(day_ordinal):
+    today = date.fromordinal(day_ordinal)
+    year, month = today.year, today.month
 
-    expiry = last_tuesday(year, month)
-    if (expiry - today).days < 5:  # switch to next month
+    expiry = _last_tuesday(year, month)
+    if (expiry - today).days <= 5:  # switch to next month
         if month == 12:
             year += 1
             month = 1
         else:
             month += 1
-        expiry = last_tuesday(year, month)
+        expiry = _last_tuesday(year, month)
 
     return expiry.strftime("%y%b").upper()
 
+def _bucket(spot_price, option_type):
+    # CE rounds down to the 100 strike, PE rounds up to the next one.
+    return (int(spot_price) // 100 + (option_type != "CE")) * 100
+
+@functools.lru_cache(maxsize=128)
+def _symbol(bucket, option_type, expiry):
+    return f"BANKNIFTY{expiry}{bucket}{option_type}"
+
 def get_option_symbol(spot_price, option_type):
-    step = 100
-    strike = int(spot_price / step) * step if option_type == "CE" else (int(spot_price / step) + 1) * step
-    expiry = get_monthly_expiry()
-    return f"BANKNIFTY{expiry}{strike}{option_type}"
+    return _symbol(_bucket(spot_price, option_type), option_type, get_monthly_expiry())
+
+# Live positions only change when an order fills, so they're kept in process:
+# seeded from Kite at startup, updated on every fill of ours, and
+# reconciled periodically to pick up fills made outside the bot.
+POSITIONS_RECONCILE_INTERVAL = 30  # seconds
+# Kite's positions view can lag a fill; snapshots taken while one of our
+# orders is in flight or within this many seconds of one are discarded.
+POSITIONS_RECONCILE_GRACE = 5  # seconds
+_live_positions = {}  # {symbol: net qty} in live mode
+_orders_in_flight = 0
+_unresolved_tags = set()  # tags of our orders whose outcome we never saw
+_last_order_at = float("-inf")  # monotonic time our last order settled
+_reconcile_task = None
+
+_held_sides = {}  # {"CE"/"PE": first held symbol on that side}
+
+def _refresh_held_sides(symbols):
+    _held_sides.clear()
+    for sym in symbols:
+        _held_sides.setdefault(sym[-2:], sym)
+
+def record_order(order, filled_qty):
+    """Applies a fill of one of our own orders to the live position store."""
+    sym = order["tradingsymbol"]
+    qty = filled_qty if order["transaction_type"] == "BUY" else -filled_qty
+    net = _live_positions.get(sym, 0) + qty
+    if net:
+        _live_positions[sym] = net
+    else:
+        _live_positions.pop(sym, None)
+    _refresh_held_sides(_live_positions)
+
+def _orders_settled():
+    return not _orders_in_flight and time_module.monotonic() - _last_order_at >= POSITIONS_RECONCILE_GRACE
+
+async def reconcile_positions():
+    """Replaces the live position store with Kite's view.
+
+    Skipped while our own orders are in flight or just settled, since
+    Kite's snapshot may not include them yet. Unresolved orders are looked
+    up by tag and released once they're final (or, past the grace period,
+    absent from the order book, i.e. never placed).
+    """
+    if not _orders_settled():
+        return
+    still_open = set()
+    if _unresolved_tags:
+        book = {o.get("tag"): o for o in await kite_request("GET", "/orders")}
+        still_open = {t for t in _unresolved_tags
+                      if t in book and book[t]["status"] not in ORDER_FINAL_STATUSES}
+    positions = (await kite_request("GET", "/portfolio/positions"))["net"]
+    if not _orders_settled():
+        return  # one of our orders went out mid-fetch; the snapshot is stale
+    _live_positions.clear()
+    _live_positions.update((p["tradingsymbol"], p["quantity"]) for p in positions if p["quantity"] != 0)
+    _refresh_held_sides(_live_positions)
+    if _unresolved_tags and not still_open:
+        logging.info("✅ Unresolved orders settled → trading resumed")
+    _unresolved_tags.intersection_update(still_open)
+
+async def positions_reconciler():
+    # Ticks every grace period so unresolved orders are cleared promptly;
+    # otherwise reconciles every POSITIONS_RECONCILE_INTERVAL.
+    last = time_module.monotonic()
+    while True:
+        await asyncio.sleep(POSITIONS_RECONCILE_GRACE)
+        if not _unresolved_tags and time_module.monotonic() - last < POSITIONS_RECONCILE_INTERVAL:
+            continue
+        last = time_module.monotonic()
+        try:
+            await reconcile_positions()
+        except Exception as e:
+            logging.warning("⚠️ Could not fetch positions: %s", e)
 
-def get_current_positions():
+@app.before_serving
+async def start_positions_reconciler():
+    global _reconcile_task
     if TEST_MODE:
-        return [{"tradingsymbol": sym, "quantity": qty} for sym, qty in fake_positions.items()]
+        return
     try:
-        positions = kite.positions()["net"]
-        return [p for p in positions if p["quantity"] != 0]
+        await reconcile_positions()
     except Exception as e:
-        logging.warning(f"⚠️ Could not fetch positions: {e}")
-        return []
+        logging.warning("⚠️ Could not fetch positions: %s", e)
+    _reconcile_task = asyncio.create_task(positions_reconciler())
+
+@app.after_serving
+async def stop_positions_reconciler():
+    if _reconcile_task:
+        _reconcile_task.cancel()
+
+def get_current_positions():
+    if TEST_MODE:
+        _refresh_held_sides(fake_positions)
+        return [{"tradingsymbol": sym, "quantity": qty} for sym, qty in fake_positions.items()]
+    return [{"tradingsymbol": sym, "quantity": qty} for sym, qty in _live_positions.items()]
 
 # ---------- TEST MODE HELPERS ----------
 @app.route('/reset_positions', methods=['GET'])
-def reset_positions():
+async def reset_positions():
     if TEST_MODE:
         fake_positions.clear()
         log_positions(final=True)
-        return jsonify({"status": "reset", "positions": fake_positions})
-    return jsonify({"status": "error", "reason": "Not in TEST_MODE"})
+        return _json({"status": "reset", "positions": fake_positions})
+    return _json({"status": "error", "reason": "Not in TEST_MODE"})
 
 @app.route('/remove_position', methods=['GET'])
-def remove_position():
+async def remove_position():
     if TEST_MODE:
         sym = request.args.get("symbol")
-        if sym in fake_positions:
-            del fake_positions[sym]
+        if fake_positions.pop(sym, None) is not None:
             log_positions(final=True)
-            return jsonify({"status": "removed", "symbol": sym, "positions": fake_positions})
-        return jsonify({"status": "not_found", "positions": fake_positions})
-    return jsonify({"status": "error", "reason": "Not in TEST_MODE"})
+            return _json({"status": "removed", "symbol": sym, "positions": fake_positions})
+        return _json({"status": "not_found", "positions": fake_positions})
+    return _json({"status": "error", "reason": "Not in TEST_MODE"})
 
 @app.route('/view_positions', methods=['GET'])
-def view_positions():
+async def view_positions():
     try:
-        return jsonify({"positions": get_current_positions()})
+        return _json({"positions": get_current_positions()})
     except Exception as e:
-        logging.error(f"❌ View positions error: {e}")
-        return jsonify({"status": "error", "message": str(e)})
+        logging.error("❌ View positions error: %s", e)
+        return _json({"status": "error", "message": str(e)})
 
 # ---------- HEALTH CHECK ----------
 @app.route('/', methods=['GET'])
-def health_check():
-    return jsonify({"status": "ok", "message": "Bot is running"}), 200
+async def health_check():
+    return _json({"status": "ok", "message": "Bot is running"})
 
 # ---------- MAIN ROUTE ----------
-last_flip_time = None
+FLIP_COOLDOWN = 2  # seconds
+last_flip_time = float("-inf")  # monotonic time of the last flip
+
+# TradingView can re-fire the same alert within milliseconds; identical
+# bodies seen within DEDUP_WINDOW seconds are acknowledged and dropped.
+DEDUP_WINDOW = 3  # seconds
+DEDUP_MAX_KEYS = 1024
+_recent_alerts = {}  # {body digest: monotonic time first seen}
+
+def alert_key(body):
+    return hashlib.blake2b(body, digest_size=8).digest()
+
+def is_duplicate_alert(key):
+    return time_module.monotonic() - _recent_alerts.get(key, float("-inf")) < DEDUP_WINDOW
+
+def remember_alert(key):
+    """Marks an alert as accepted; only call once it has been queued."""
+    now = time_module.monotonic()
+    if len(_recent_alerts) >= DEDUP_MAX_KEYS:
+        for k, seen in list(_recent_alerts.items()):
+            if now - seen >= DEDUP_WINDOW:
+                del _recent_alerts[k]
+    _recent_alerts[key] = now
 
 @app.route('/webhook', methods=['POST'])
-def webhook():
-    global last_flip_time
+async def webhook():
     try:
         if not is_market_open():
-            return jsonify({"status": "rejected", "reason": "Outside market hours"})
+            return _json({"status": "rejected", "reason": "Outside market hours"})
 
-        data = request.get_json(silent=True)
+        body = await request.get_data(cache=False)
+        key = alert_key(body)
+        if is_duplicate_alert(key):
+            return _json({"status": "skipped", "reason": "duplicate alert"})
+        try:
+            data = orjson.loads(body)
+        except orjson.JSONDecodeError:
+            data = None
         if not data:
-            raw = request.data.decode('utf-8', errors='replace')
-            logging.warning(f"⚠️ Raw webhook body (not valid JSON): {raw}")
-            return jsonify({"status": "error", "reason": "invalid JSON", "raw": raw})
+            raw = body.decode('utf-8', errors='replace')
+            logging.warning("⚠️ Raw webhook body (not valid JSON): %s", raw)
+            return _json({"status": "error", "reason": "invalid JSON", "raw": raw})
 
         option_type = data.get("type")  # "CE" or "PE"
+        if option_type not in ("CE", "PE"):
+            return _json({"status": "error", "reason": f"Unknown option type: {option_type}"})
         qty = int(data.get("qty", DEFAULT_QTY))
-        logging.info(f"📩 Received {option_type} Alert")
-
-        spot = safe_ltp("NSE:NIFTY BANK")
-        main_symbol = get_option_symbol(spot, option_type)
-        opposite_type = "PE" if option_type == "CE" else "CE"
-        positions = get_current_positions()
-        opposite_symbol = None
-        for p in positions:
-            if p["tradingsymbol"].endswith(opposite_type):
-                opposite_symbol = p["tradingsymbol"]
-                break
- 
+        if qty <= 0:
+            return _json({"status": "error", "reason": f"Invalid quantity: {qty}"})
+        logging.info("📩 Received %s Alert", option_type)
+
+        # Ack immediately; the broker side runs on the order worker so slow
+        # Kite calls never hold up TradingView's delivery.
+        _order_queue.put_nowait((option_type, qty))
+        remember_alert(key)
+        return _json({"status": "queued", "type": option_type, "qty": qty}, status=202)
+
+    except asyncio.QueueFull:
+        logging.error("❌ Order queue full → dropping alert")
+        return _json({"status": "error", "reason": "order queue full"}, status=503)
+    except Exception as e:
+        logging.error("❌ Error: %s", e)
+        return _json({"status": "error", "message": str(e)})
+
+# ---------- ORDER WORKER ----------
+# A single consumer executes alerts strictly in arrival order.
+ORDER_QUEUE_SIZE = 64
+ORDER_SHUTDOWN_TIMEOUT = 20  # seconds; below gunicorn's graceful_timeout
+_order_queue = None
+_order_worker_task = None
+_order_worker_stopping = False
+_current_alert = None  # task running the alert being executed
+
+@app.before_serving
+async def start_order_worker():
+    global _order_queue, _order_worker_task
+    _order_queue = asyncio.Queue(maxsize=ORDER_QUEUE_SIZE)
+    _order_worker_task = asyncio.create_task(order_worker())
+
+@app.after_serving
+async def stop_order_worker():
+    """Lets the alert in progress finish, then drops (and logs) the rest.
+
+    Cancelling mid-alert could leave a flip with the exit filled and the
+    entry never sent.
+    """
+    global _order_worker_stopping
+    _order_worker_stopping = True
+    if _current_alert and not _current_alert.done():
+        logging.info("⏳ Shutting down → waiting for the alert in progress")
+        try:
+            await asyncio.wait_for(asyncio.shield(_current_alert), ORDER_SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logging.error("❌ Alert still running after %ss at shutdown", ORDER_SHUTDOWN_TIMEOUT)
+        except Exception:
+            pass  # already logged by the worker
+    _order_worker_task.cancel()
+    while not _order_queue.empty():
+        option_type, qty = _order_queue.get_nowait()
+        logging.warning("⚠️ Shutting down → discarding queued %s alert (qty: %s)", option_type, qty)
+
+async def order_worker():
+    global _current_alert
+    while not _order_worker_stopping:
+        option_type, qty = await _order_queue.get()
+        if _order_worker_stopping:
+            logging.warning("⚠️ Shutting down → discarding queued %s alert (qty: %s)", option_type, qty)
+            break
+        # Run each alert as its own task, shielded from the worker's
+        # cancellation, so shutdown can wait for it to finish.
+        _current_alert = asyncio.create_task(execute_alert(option_type, qty))
+        try:
+            result = await asyncio.shield(_current_alert)
+            logging.info("📤 %s alert done: %s", option_type, result)
+        except Exception as e:
+            logging.error("❌ Error: %s", e)
+        finally:
+            _order_queue.task_done()
 
+async def execute_alert(option_type, qty):
+    """Runs the entry/flip logic for one alert and returns its outcome."""
+    global last_flip_time
 
-        if last_flip_time and (datetime.now() - last_flip_time).total_seconds() < 2:
-            logging.info("⏳ Flip cooldown active → ignoring this alert")
-            log_positions(final=True)
-            return jsonify({"status": "skipped", "reason": "flip cooldown"})
-
-        if not positions:
-            logging.info(f"🆕 Flat → Entering {option_type} @ {main_symbol} (qty: {qty})")
-            if TEST_MODE:
-                fake_positions[main_symbol] = qty
-                log_positions(final=True)
-                return jsonify({"status": "test", "entry": main_symbol, "positions": fake_positions})
-            # Live order
-            place_order(main_symbol, qty, "BUY")
-            log_positions(final=True)
-            return jsonify({"status": "success", "entry": main_symbol})
+    if time_module.monotonic() - last_flip_time < FLIP_COOLDOWN:
+        logging.info("⏳ Flip cooldown active → ignoring this alert")
+        log_positions(final=True)
+        return {"status": "skipped", "reason": "flip cooldown"}
 
-        if any(p["tradingsymbol"].endswith(option_type) for p in positions):
-            logging.info(f"⏩ Already holding a {option_type} position → skipping new {main_symbol}")
-            log_positions(final=True)
-            return jsonify({"status": "skipped", "reason": f"Already in {option_type}"})
+    if _unresolved_tags:
+        logging.warning("⚠️ Unresolved orders pending → ignoring alert until reconciled")
+        return {"status": "skipped", "reason": "positions unconfirmed"}
 
+    # Duplicate-side alerts are answered before any LTP round-trip.
+    positions = get_current_positions()
+    if option_type in _held_sides:
+        logging.info("⏩ Already holding a %s position → skipping", option_type)
+        log_positions(final=True)
+        return {"status": "skipped", "reason": f"Already in {option_type}"}
 
-        logging.info(f"🔄 Switching: Exit {opposite_type} → Enter {option_type} @ {main_symbol} (qty: {qty})")
+    spot = await safe_ltp("NSE:NIFTY BANK")
+    main_symbol = get_option_symbol(spot, option_type)
 
+    if not positions:
+        logging.info("🆕 Flat → Entering %s @ %s (qty: %s)", option_type, main_symbol, qty)
         if TEST_MODE:
-            if opposite_symbol in fake_positions:
-                del fake_positions[opposite_symbol]
             fake_positions[main_symbol] = qty
-            last_flip_time = datetime.now()
             log_positions(final=True)
-            return jsonify({"status": "test", "flip": {"exit": opposite_symbol, "enter": main_symbol}, "positions": fake_positions})
-
-        # Live flip
-        exit_position(opposite_symbol, qty)
-        place_order(main_symbol, qty, "BUY")
-        last_flip_time = datetime.now()
+            return {"status": "test", "entry": main_symbol, "positions": dict(fake_positions)}
+        # Live order
+        await place_order(main_symbol, qty, "BUY")
         log_positions(final=True)
-        return jsonify({"status": "success", "flip": {"exit": opposite_symbol, "enter": main_symbol}})
+        return {"status": "success", "entry": main_symbol}
+
+    opposite_type = "PE" if option_type == "CE" else "CE"
+    opposite_symbol = _held_sides.get(opposite_type)
 
+    logging.info("🔄 Switching: Exit %s → Enter %s @ %s (qty: %s)", opposite_type, option_type, main_symbol, qty)
+
+    if TEST_MODE:
+        fake_positions.pop(opposite_symbol, None)
+        fake_positions[main_symbol] = qty
+        last_flip_time = time_module.monotonic()
+        log_positions(final=True)
+        return {"status": "test", "flip": {"exit": opposite_symbol, "enter": main_symbol}, "positions": dict(fake_positions)}
+
+    # Live flip: both legs are validated up front, then the exit goes first
+    # and the entry is only sent once the exit has filled. A rejected exit
+    # aborts the flip before we ever hold both sides. Don't parallelise the
+    # legs (gather or a thread pool): the entry could fill while the exit is
+    # rejected, leaving both sides open.
+    exit_leg = order_payload(opposite_symbol, "SELL", qty)
+    entry_leg = order_payload(main_symbol, "BUY", qty)
+    await submit_order(exit_leg)
+    try:
+        await submit_order(entry_leg)
     except Exception as e:
-        logging.error(f"❌ Error: {e}")
-        return jsonify({"status": "error", "message": str(e)})
+        logging.error("❌ Exited %s but entry %s failed → now flat: %s", opposite_symbol, main_symbol, e)
+        raise
+    last_flip_time = time_module.monotonic()
+    log_positions(final=True)
+    return {"status": "success", "flip": {"exit": opposite_symbol, "enter": main_symbol}}
 
 # ---------- START SERVER ----------
 if __name__ == "__main__":
+    import uvicorn
     port = int(os.environ.get("PORT", 10000))
-    app.run(host="0.0.0.0", port=port)
+    uvicorn.run(app, host="0.0.0.0", port=port, loop="uvloop", http="httptools")